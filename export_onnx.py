@@ -0,0 +1,43 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MODEL_ID = "BAAI/bge-small-en-v1.5"
+# Same default as the server's ONNX_MODEL_PATH so the exported model is picked up without extra config
+ONNX_MODEL_PATH = os.environ.get("ONNX_MODEL_PATH", "bge-onnx/model_int8.onnx")
+# Quantization preset matching the deployment CPU: avx512_vnni, avx512, avx2 or arm64
+QUANTIZATION_TARGET = os.environ.get("QUANTIZATION_TARGET", "avx512_vnni")
+
+def export_model():
+    """Export the embedding model to ONNX, graph-optimize it and quantize it to int8
+
+    Needs the export extras, which the server itself does not:
+        pip install "optimum[onnxruntime]"
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoOptimizationConfig, AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    output_dir = os.path.dirname(ONNX_MODEL_PATH) or "."
+
+    print(f'Exporting {MODEL_ID} to ONNX...')
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    # Writes tokenizer.json, which the server loads from next to the model
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(output_dir)
+
+    print('Optimizing graph (O3)...')
+    optimizer = ORTOptimizer.from_pretrained(model)
+    optimizer.optimize(save_dir=output_dir, optimization_config=AutoOptimizationConfig.O3())
+
+    print(f'Quantizing to int8 ({QUANTIZATION_TARGET})...')
+    quantizer = ORTQuantizer.from_pretrained(output_dir, file_name="model_optimized.onnx")
+    qconfig = getattr(AutoQuantizationConfig, QUANTIZATION_TARGET)(is_static=False, per_channel=False)
+    quantized_path = quantizer.quantize(save_dir=output_dir, quantization_config=qconfig)
+
+    # ORTQuantizer names its output after the input model; move it to where the server looks
+    os.replace(os.path.join(quantized_path, "model_optimized_quantized.onnx"), ONNX_MODEL_PATH)
+    print(f'✅ Saved quantized model to {ONNX_MODEL_PATH}')
+
+if __name__ == "__main__":
+    export_model()
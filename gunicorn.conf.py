@@ -0,0 +1,29 @@
+# Gunicorn settings used by start.sh; each value can be overridden from the environment
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 3000)}"
+wsgi_app = "server:flask_app"
+
+# server.py creates its HTTP sessions and Supabase client at import time; loading
+# the app after fork gives every worker its own copies
+preload_app = False
+
+# gevent workers let idle SSE connections and network waits yield instead of pinning threads
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+
+# Bounded concurrency per worker: connections for gevent, pool size for gthread
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+
+# Leave room for a cold embedding call plus its retries before a worker counts as hung
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+
+# Keep worker heartbeat files on tmpfs so a slow disk cannot stall them
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+def post_worker_init(worker):
+    # Background threads and signal handlers belong to the worker, not to every importer of server.py
+    import server
+    server.start_background_services()
@@ -1,48 +1,79 @@
 import os
-import re
-from server import generate_embedding
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from sentence_transformers import SentenceTransformer
 
 load_dotenv()
 
-# Initialize Supabase
-url: str = os.environ.get("SUPABASE_URL", "")
-key: str = os.environ.get("SUPABASE_KEY", "")
-if not url or not key:
+# Check the Supabase settings before server.py builds its client from them
+if not os.environ.get("SUPABASE_URL") or not os.environ.get("SUPABASE_KEY"):
     raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in environment variables.")
 
-supabase: Client = create_client(url, key)
+# Reuse the server's Supabase client and embedding backend instead of creating our own
+from server import generate_embedding, supabase
+
+# Number of chunks embedded and inserted per request (keep within HF rate limits)
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 32))
+# Number of embedding requests kept in flight while earlier rows are uploaded
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", 4))
+# Maximum number of rows sent to Supabase per insert
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", 100))
+
+# Sections longer than this are split further at their ### subheaders
+MAX_SECTION_CHARS = 2000
+# Chunks of this many characters or fewer (ignoring surrounding whitespace) are dropped
+MIN_CHUNK_CHARS = 50
+
+def _stripped_length(text: str, start: int, end: int) -> int:
+    """Length of text[start:end].strip(), without building either string"""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return end - start
 
 def chunk_documentation(markdown_text: str) -> list:
-    """Split documentation into meaningful chunks"""
+    """Split documentation into meaningful chunks
+    
+    Single pass over the line starts: every '## ' line opens a section and
+    sections over MAX_SECTION_CHARS are cut again at their '### ' lines.
+    Chunks are slices of the input; content before the first '## ' is skipped.
+    """
     chunks = []
+    text_len = len(markdown_text)
+    section_start = -1
+    subsection_starts = []
     
-    # Split by ## headers (main sections) using multiline regex
-    # This mimics markdown.split(/^## /m)
-    sections = re.split(r'^## ', markdown_text, flags=re.MULTILINE)
+    def close_section(section_end: int):
+        # Keep main header with intro, then one chunk per subsection
+        if section_end - section_start > MAX_SECTION_CHARS:
+            bounds = [section_start, *subsection_starts, section_end]
+        else:
+            bounds = [section_start, section_end]
+        
+        # Only slice out chunks that pass the length filter
+        for start, end in zip(bounds, bounds[1:]):
+            if end - start > MIN_CHUNK_CHARS and _stripped_length(markdown_text, start, end) > MIN_CHUNK_CHARS:
+                chunks.append(markdown_text[start:end])
     
-    # Iterate starting from index 1 (skipping the pre-header content), matching JS logic
-    for section_content in sections[1:]:
-        section = '## ' + section_content
+    line_start = 0
+    while line_start < text_len:
+        if markdown_text.startswith('## ', line_start):
+            if section_start >= 0:
+                close_section(line_start)
+            section_start = line_start
+            subsection_starts = []
+        elif section_start >= 0 and markdown_text.startswith('### ', line_start):
+            subsection_starts.append(line_start)
         
-        # If section is too large (>2000 chars), split further
-        if len(section) > 2000:
-            # Split by ### subheaders
-            subsections = re.split(r'^### ', section, flags=re.MULTILINE)
-            
-            # Keep main header with intro (index 0)
-            chunks.append('## ' + subsections[0])
-            
-            # Add subsections
-            for sub in subsections[1:]:
-                chunks.append('### ' + sub)
-        else:
-            chunks.append(section)
-            
-    # Filter out short chunks
-    return [chunk for chunk in chunks if len(chunk.strip()) > 50]
+        newline = markdown_text.find('\n', line_start)
+        if newline == -1:
+            break
+        line_start = newline + 1
+    
+    if section_start >= 0:
+        close_section(text_len)
+    
+    return chunks
 
 def populate_vector_db():
     try:
@@ -57,22 +88,32 @@ def populate_vector_db():
         
         print('Generating embeddings and storing in Supabase...')
         
-        for i, chunk in enumerate(chunks):
-            print(f'Processing chunk {i + 1}/{len(chunks)}...')
-            
-            # Generate embedding locally
-            embedding = generate_embedding(chunk)
-            
-            # Store in Supabase
-            data = {
-                "content": chunk,
-                "embedding": embedding
-            }
-            
-            response = supabase.table('strudel_docs').insert(data).execute()
+        batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+        rows = []
+        inserted = 0
+        
+        # executor.map keeps up to EMBED_WORKERS batched embedding requests in flight
+        # while this thread uploads; results are yielded in input order
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor:
+            for batch, embeddings in zip(batches, executor.map(generate_embedding, batches)):
+                # supabase-py sends JSON with the stdlib encoder, which needs plain lists
+                rows.extend(
+                    {"content": chunk, "embedding": embedding}
+                    for chunk, embedding in zip(batch, embeddings.tolist())
+                )
+                
+                # supabase-py raises exceptions on error usually
+                # Note: older versions returned {data, error}, newer raise postgrest.exceptions.APIError
+                while len(rows) >= INSERT_BATCH_SIZE:
+                    supabase.table('strudel_docs').insert(rows[:INSERT_BATCH_SIZE]).execute()
+                    rows = rows[INSERT_BATCH_SIZE:]
+                    inserted += INSERT_BATCH_SIZE
+                    print(f'Stored {inserted}/{len(chunks)} chunks...')
             
-            # supabase-py raises exceptions on error usually, but we can check response
-            # Note: older versions returned {data, error}, newer raise postgrest.exceptions.APIError
+            if rows:
+                supabase.table('strudel_docs').insert(rows).execute()
+                inserted += len(rows)
+                print(f'Stored {inserted}/{len(chunks)} chunks...')
             
         print('✅ Successfully populated vector database!')
         
@@ -85,7 +126,7 @@ def populate_vector_db():
         test_embedding = generate_embedding(test_query)
         
         rpc_params = {
-            'query_embedding': test_embedding,
+            'query_embedding': test_embedding.tolist(),
             'match_threshold': 0.5,
             'match_count': 3
         }
@@ -1,61 +1,644 @@
 import os
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from supabase import create_client, Client
-from flask import Flask, Response, jsonify, request, stream_with_context
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import time
+import threading
+import functools
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+import string
+import numpy as np
+import fastjsonschema
+import hmac
+import signal
+import logging
 
 load_dotenv()
 
-# Initialize Supabase client
-supabase: Client = create_client(
-    os.getenv("SUPABASE_URL", ""),
-    os.getenv("SUPABASE_KEY", "")
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
 )
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
+SUPABASE_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+
+# Initialize Supabase client
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # Hugging Face API configuration
 HF_API_TOKEN = os.getenv("HF_API_TOKEN", "")
 HF_API_URL = "https://router.huggingface.co/hf-inference/models/BAAI/bge-small-en-v1.5/pipeline/feature-extraction"
+HF_MAX_RETRIES = int(os.getenv("HF_MAX_RETRIES", 3))
+HF_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+HF_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+HF_RETRY_BACKOFF = 0.3
+# Worst case for one HF call: every attempt times out, plus urllib3's backoff
+# sleeps between retries (none before the first, then factor * 2**n)
+HF_CALL_BUDGET = (HF_MAX_RETRIES + 1) * sum(HF_TIMEOUT) + sum(
+    HF_RETRY_BACKOFF * 2 ** n for n in range(1, HF_MAX_RETRIES)
+)
+EMBEDDING_DIM = 384
+
+# Local embedding model: BAAI/bge-small-en-v1.5 exported to ONNX and int8-quantized, e.g.
+#   optimum-cli export onnx --model BAAI/bge-small-en-v1.5 --optimize O3 bge-onnx/
+# then dynamic quantization with optimum.onnxruntime.ORTQuantizer to bge-onnx/model_int8.onnx
+# (export_onnx.py runs both steps). tokenizer.json is expected next to the model.
+# EMBEDDINGS_BACKEND: "local" requires the model, "hf" always uses the API,
+# "auto" uses the model when present and falls back to the HF API otherwise.
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "auto")
+ONNX_MODEL_PATH = os.getenv("ONNX_MODEL_PATH", "bge-onnx/model_int8.onnx")
+ONNX_MAX_LENGTH = 512
+
+# Dynamic batching of concurrent query embeddings
+EMBED_MAX_BATCH = int(os.getenv("MAX_BATCH", 32))
+EMBED_MAX_DELAY_MS = float(os.getenv("MAX_DELAY_MS", 8))
+# Seconds a request waits for its batch: one full HF call plus time queued for the batch
+EMBED_TIMEOUT = HF_CALL_BUDGET + 2
+# Embed a dummy text at startup so the first query doesn't hit a cold model
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "1") != "0"
+# On a search miss, embed likely rephrasings of the query in the background so a
+# follow-up from the same agent skips the embedding round trip
+QUERY_PREFETCH = os.getenv("QUERY_PREFETCH", "1") != "0"
+QUERY_PREFETCH_WORKERS = 4
+QUERY_PREFETCH_MAX_PENDING = 64  # variants queued beyond this are dropped
+
+# Search configuration
+MATCH_THRESHOLD = 0.2
+DEFAULT_MAX_RESULTS = 3
+MAX_RESULTS_LIMIT = 50  # upper bound accepted for maxResults
+NO_RESULTS_TEXT = "No relevant documentation found for your query."
+
+# Query cache configuration
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 4096))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1024))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 3600))  # seconds, 0 = never expire
+
+# In-process HNSW index over strudel_docs (needs the optional usearch package).
+# Searches fall back to the Supabase RPC until it is built or when it is disabled.
+DOC_INDEX_ENABLED = os.getenv("DOC_INDEX", "1") != "0"
+DOC_INDEX_REFRESH = float(os.getenv("DOC_INDEX_REFRESH", 0))  # seconds between rebuilds, 0 = build once
+DOC_INDEX_PAGE_SIZE = 1000  # PostgREST's default max rows per request
+# Vector storage in the index: 'f32', 'f16' (2x smaller) or 'i8' (4x smaller)
+DOC_INDEX_DTYPE = os.getenv("DOC_INDEX_DTYPE", "f32")
+if DOC_INDEX_DTYPE not in ("f32", "f16", "i8"):
+    raise ValueError(f"DOC_INDEX_DTYPE must be f32, f16 or i8, got {DOC_INDEX_DTYPE!r}")
+
+# Bearer token for admin endpoints such as /cache/clear (disabled when unset)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Seconds between keepalive comments on idle SSE connections
+SSE_KEEPALIVE_INTERVAL = 30
+
+# Pooled session so repeated embedding calls reuse the TCP/TLS connection (keep-alive).
+# Retries with exponential backoff while the model is loading or we are rate limited.
+_hf_session = requests.Session()
+_hf_session.headers["Authorization"] = f"Bearer {HF_API_TOKEN}"
+_hf_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=HF_MAX_RETRIES,
+        backoff_factor=HF_RETRY_BACKOFF,
+        status_forcelist=HF_RETRY_STATUS_CODES,
+        allowed_methods=None,  # embedding POSTs are idempotent
+        raise_on_status=False
+    )
+))
+
+# Search RPCs go straight to PostgREST over a pooled keep-alive session instead of
+# through supabase-py, so warm queries skip the TLS handshake to *.supabase.co
+_supabase_session = requests.Session()
+_supabase_session.headers.update({
+    "apikey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+    "Content-Type": "application/json",
+    "Accept": "application/json"
+})
+_supabase_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=None,  # search functions are read-only
+        raise_on_status=False
+    )
+))
+
+def supabase_rpc(function: str, params: dict):
+    """Call a Postgres function through PostgREST and return its decoded result"""
+    response = _supabase_session.post(
+        f"{SUPABASE_URL}/rest/v1/rpc/{function}",
+        # Embeddings are passed as ndarrays; orjson writes them as JSON lists
+        data=orjson.dumps(params, option=orjson.OPT_SERIALIZE_NUMPY),
+        timeout=SUPABASE_TIMEOUT
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+logger.info("Server starting with SSE MCP protocol...")
+
+def load_onnx_model():
+    """Load the local ONNX embedding model and its tokenizer, if present"""
+    if EMBEDDINGS_BACKEND not in ("auto", "local", "hf"):
+        raise ValueError(f"EMBEDDINGS_BACKEND must be auto, local or hf, got {EMBEDDINGS_BACKEND!r}")
+    if EMBEDDINGS_BACKEND == "hf":
+        logger.info("EMBEDDINGS_BACKEND=hf, using Hugging Face Inference API")
+        return None, None
+    if not os.path.exists(ONNX_MODEL_PATH):
+        if EMBEDDINGS_BACKEND == "local":
+            raise ValueError(f"EMBEDDINGS_BACKEND=local but no ONNX model at {ONNX_MODEL_PATH}; run export_onnx.py first")
+        logger.info("No ONNX model at %s, using Hugging Face Inference API", ONNX_MODEL_PATH)
+        return None, None
+
+    import onnxruntime as ort
+    from tokenizers import Tokenizer
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = os.cpu_count() or 1
+    session = ort.InferenceSession(
+        ONNX_MODEL_PATH,
+        sess_options=sess_options,
+        providers=['CPUExecutionProvider']
+    )
+
+    tokenizer = Tokenizer.from_file(os.path.join(os.path.dirname(ONNX_MODEL_PATH), 'tokenizer.json'))
+    tokenizer.enable_truncation(max_length=ONNX_MAX_LENGTH)
+    tokenizer.enable_padding()
+
+    logger.info("Loaded ONNX embedding model from %s", ONNX_MODEL_PATH)
+    return session, tokenizer
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """L2-normalize each row of a (n, EMBEDDING_DIM) array"""
+    return embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
+
+def _cls_pool_normalize(token_embeddings: np.ndarray) -> np.ndarray:
+    """Take each sequence's [CLS] vector and L2-normalize it
 
-print("Server starting with SSE MCP protocol...")
+    Written as plain loops so Numba can compile it to a single vectorized pass.
+    """
+    batch_size, _, dim = token_embeddings.shape
+    pooled = np.empty((batch_size, dim), dtype=np.float32)
+    for b in range(batch_size):
+        norm = 0.0
+        for d in range(dim):
+            norm += token_embeddings[b, 0, d] * token_embeddings[b, 0, d]
+        scale = 1.0 / (np.sqrt(norm) + 1e-12)
+        for d in range(dim):
+            pooled[b, d] = token_embeddings[b, 0, d] * scale
+    return pooled
 
-def generate_embedding(text: str) -> list[float]:
-    """Generate embedding using Hugging Face Inference API"""
-    headers = {"Authorization": f"Bearer {HF_API_TOKEN}"}
+def load_pooling_kernel():
+    """JIT-compile the pooling kernel with Numba, or fall back to NumPy if it is not installed"""
+    try:
+        from numba import njit
+    except ImportError:
+        return lambda token_embeddings: normalize_embeddings(token_embeddings[:, 0])
+
+    kernel = njit(cache=True, fastmath=True)(_cls_pool_normalize)
+    # Compile at startup rather than on the first query
+    kernel(np.zeros((1, 8, EMBEDDING_DIM), dtype=np.float32))
+    return kernel
+
+onnx_session, onnx_tokenizer = load_onnx_model()
+pool_embeddings = load_pooling_kernel() if onnx_session is not None else None
+
+def generate_embedding(text: str | list[str]) -> np.ndarray:
+    """Generate embedding(s) with the local ONNX model, or the HF Inference API if not loaded
+
+    A list of texts is embedded as a single batch and an (n, EMBEDDING_DIM)
+    float32 array is returned, one unit-normalized row per input in the same
+    order; a single text gives an (EMBEDDING_DIM,) array. Convert with
+    .tolist() only where a JSON client needs plain lists.
+    """
+    if onnx_session is not None:
+        return generate_embedding_onnx(text)
+    return generate_embedding_hf(text)
+
+def generate_embedding_onnx(text: str | list[str]) -> np.ndarray:
+    """Generate embedding(s) in-process with the ONNX Runtime model"""
+    batched = isinstance(text, list)
+    encodings = onnx_tokenizer.encode_batch(text if batched else [text])
+
+    features = {
+        "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+        "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64)
+    }
+    inputs = {i.name: features[i.name] for i in onnx_session.get_inputs()}
+    token_embeddings = onnx_session.run(None, inputs)[0]
+
+    # BGE uses the [CLS] token as the sentence embedding, L2-normalized
+    embeddings = pool_embeddings(token_embeddings)
+    return embeddings if batched else embeddings[0]
+
+def generate_embedding_hf(text: str | list[str]) -> np.ndarray:
+    """Generate embedding(s) using Hugging Face Inference API
+
+    A list of texts is sent as a single batched request and one embedding
+    per input is returned, in the same order.
+    """
+    batched = isinstance(text, list)
     
     try:
-        response = requests.post(
+        response = _hf_session.post(
             HF_API_URL,
-            headers=headers,
-            json={"inputs": text}
+            json={"inputs": text},
+            timeout=HF_TIMEOUT
         )
         
-        if response.status_code == 200:
-            result = response.json()
-            
-            if isinstance(result, list):
-                if len(result) > 0 and isinstance(result[0], list):
-                    embedding = result[0]
-                else:
-                    embedding = result
-                
-                if len(embedding) != 384:
-                    raise ValueError(f"Expected 384-dimensional embedding, got {len(embedding)}")
-                
-                return embedding
-            else:
-                raise ValueError(f"Unexpected response format: {type(result)}")
-        else:
-            error_msg = f"HF API error: {response.status_code} - {response.text}"
-            print(error_msg)
-            raise Exception(error_msg)
+        if response.status_code != 200:
+            raise Exception(f"HF API error: {response.status_code} - {response.text}")
+
+        # Parse straight into an array; a single text may come back nested one level
+        embeddings = np.asarray(orjson.loads(response.content), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+
+        # One shape check replaces per-vector length checks
+        expected_shape = (len(text) if batched else 1, EMBEDDING_DIM)
+        if embeddings.shape != expected_shape:
+            raise ValueError(f"Expected embeddings of shape {expected_shape}, got {embeddings.shape}")
+
+        # Unit-normalize so cosine similarity is a plain dot product downstream
+        embeddings = normalize_embeddings(embeddings)
+        return embeddings if batched else embeddings[0]
             
     except Exception as e:
-        print(f"Error generating embedding: {str(e)}")
+        logger.error("Error generating embedding: %s", e)
         raise
 
+class EmbeddingBatcher:
+    """Coalesce concurrent embedding requests into batched calls
+
+    A background thread takes the first queued text, keeps collecting until
+    max_batch texts are queued or max_delay_ms has passed, then embeds the
+    distinct texts with a single generate_embedding call and resolves each
+    Future with the embedding for its text.
+    """
+
+    def __init__(self, max_batch: int, max_delay_ms: float):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue: queue.Queue[tuple[str, Future]] = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _collect(self) -> list[tuple[str, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Concurrent misses for the same query share one slot in the request
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                embeddings = dict(zip(texts, generate_embedding(texts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for text, future in batch:
+                future.set_result(embeddings[text])
+
+embedding_batcher = EmbeddingBatcher(EMBED_MAX_BATCH, EMBED_MAX_DELAY_MS)
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def get_query_embedding(query: str) -> np.ndarray:
+    """Embed a search query, memoizing exact repeats
+
+    The cached array is shared between callers, so it is made read-only.
+    """
+    try:
+        embedding = embedding_batcher.submit(query).result(timeout=EMBED_TIMEOUT)
+    except TimeoutError:
+        # concurrent.futures' TimeoutError has an empty message
+        raise TimeoutError(f"Embedding the query timed out after {EMBED_TIMEOUT:.0f}s") from None
+    # The batcher hands back a row view; copy it so the cache doesn't keep the whole batch alive
+    embedding = embedding.copy()
+    embedding.setflags(write=False)
+    return embedding
+
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+_prefetch_executor = ThreadPoolExecutor(max_workers=QUERY_PREFETCH_WORKERS, thread_name_prefix="query-prefetch")
+_prefetch_slots = threading.BoundedSemaphore(QUERY_PREFETCH_MAX_PENDING)
+
+def query_variants(query: str) -> list[str]:
+    """Rephrasings an agent is likely to send next: lowercased, without punctuation, 'how to ...'"""
+    lowered = query.lower()
+    variants = [lowered, " ".join(lowered.translate(_PUNCTUATION_TABLE).split())]
+    if not lowered.startswith("how to "):
+        variants.append("how to " + query)
+    return [v for v in dict.fromkeys(variants) if v and v != query]
+
+def _prefetch_query_embedding(query: str):
+    try:
+        get_query_embedding(query)
+    except Exception as e:
+        logger.debug("Prefetching embedding for %r failed: %s", query, e)
+    finally:
+        _prefetch_slots.release()
+
+def prefetch_query_variants(query: str) -> None:
+    """Warm the query embedding cache for query_variants(query), without blocking
+
+    The variants go through the embedding batcher, so they usually share a
+    single backend request.
+    """
+    for variant in query_variants(query):
+        if not _prefetch_slots.acquire(blocking=False):
+            return
+        _prefetch_executor.submit(_prefetch_query_embedding, variant)
+
+def quantize_embedding(embedding) -> tuple[np.ndarray, np.ndarray]:
+    """Scalar-quantize embedding(s) to int8, 4x smaller than float32
+
+    Each vector is scaled so its largest component maps to +/-127, which keeps
+    far more precision than a fixed scale for 384-d unit vectors. Returns the
+    int8 codes and the per-vector scale, so codes * scale ~= embedding.
+    """
+    embedding = np.asarray(embedding, dtype=np.float32)
+    peak = np.maximum(np.abs(embedding).max(axis=-1, keepdims=True), 1e-12)
+    codes = np.rint(embedding * (127 / peak)).astype(np.int8)
+    return codes, (peak / 127).squeeze(-1)
+
+def load_dot_kernel():
+    """Return (f(query, keys), key dtype) for scoring semantic cache keys
+
+    f gives the dot product of query with each row of keys; embeddings are
+    unit-normalized, so this is already cosine similarity. With SimSIMD keys
+    are int8 and scored by its batched int8 kernel. Without it keys stay
+    float32 and go through NumPy BLAS, since upcasting int8 keys on every
+    lookup costs more than it saves.
+    """
+    try:
+        import simsimd
+    except ImportError:
+        def dot_products(query: np.ndarray, keys: np.ndarray) -> np.ndarray:
+            return keys @ query
+
+        return dot_products, np.float32
+
+    def dot_products(query: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        return np.asarray(simsimd.cdist(query.reshape(1, -1), keys, metric='dot')).reshape(-1)
+
+    return dot_products, np.int8
+
+dot_products, CACHE_KEY_DTYPE = load_dot_kernel()
+
+class SemanticCache:
+    """Bounded cache of search results keyed by query embedding
+
+    A lookup hits when a live cached embedding in the same namespace has
+    cosine similarity >= threshold with the query. With SimSIMD keys are
+    stored as int8 (384 B each) plus one float scale, and similarity is their
+    dot product rescaled; near the threshold the error is ~5e-4. Otherwise
+    keys are float32 with a scale of 1.
+    Entries expire after ttl seconds (0 disables expiry); when the cache is
+    full the least recently used entry is replaced.
+    """
+
+    _EMPTY = -1  # namespace marking a free slot
+
+    def __init__(self, max_size: int, threshold: float, ttl: float):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # One contiguous matrix so similarity is a single batched kernel call
+        self._keys = np.zeros((max_size, EMBEDDING_DIM), dtype=CACHE_KEY_DTYPE)
+        self._scales = np.zeros(max_size, dtype=np.float32)
+        self._namespaces = np.full(max_size, self._EMPTY, dtype=np.int64)
+        self._stored_at = np.zeros(max_size)
+        self._last_used = np.zeros(max_size)
+        self._values: list[str | None] = [None] * max_size
+
+    def _encode(self, embedding) -> tuple[np.ndarray, np.ndarray | float]:
+        """Key vector and scale for an embedding, in the dtype the keys are stored in"""
+        if self._keys.dtype == np.int8:
+            return quantize_embedding(embedding)
+        return np.asarray(embedding, dtype=np.float32), 1.0
+
+    def get(self, embedding, namespace: int) -> str | None:
+        if self.max_size <= 0:
+            return None
+        query, query_scale = self._encode(embedding)
+        now = time.monotonic()
+        with self._lock:
+            if self.ttl > 0:
+                self._namespaces[now - self._stored_at > self.ttl] = self._EMPTY
+            sims = dot_products(query, self._keys) * (self._scales * query_scale)
+            sims[self._namespaces != namespace] = -np.inf
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                self._last_used[best] = now
+                return self._values[best]
+        return None
+
+    def put(self, embedding, namespace: int, value: str) -> None:
+        if self.max_size <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            free = np.flatnonzero(self._namespaces == self._EMPTY)
+            slot = int(free[0]) if free.size else int(np.argmin(self._last_used))
+            self._keys[slot], self._scales[slot] = self._encode(embedding)
+            self._namespaces[slot] = namespace
+            self._stored_at[slot] = now
+            self._last_used[slot] = now
+            self._values[slot] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._namespaces[:] = self._EMPTY
+            self._values = [None] * self.max_size
+
+search_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
+
+class DocumentIndex:
+    """In-memory HNSW index over all strudel_docs rows
+
+    Serves the same top-k cosine search as match_documents without a network
+    round trip. search() returns None until an index has been built, so
+    callers can fall back to the Supabase RPC.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._contents: list[str] = []
+        self._build_lock = threading.Lock()  # one build at a time
+
+    def start(self, refresh_seconds: float) -> None:
+        """Build the index in a background thread, rebuilding every refresh_seconds if > 0"""
+        threading.Thread(target=self._run, args=(refresh_seconds,), name="doc-index", daemon=True).start()
+
+    def refresh(self, on_built=None) -> None:
+        """Rebuild the index once in a background thread, then call on_built()
+
+        The current index keeps serving until the new one is swapped in.
+        """
+        threading.Thread(target=self._run, args=(0, on_built), name="doc-index-refresh", daemon=True).start()
+
+    def _run(self, refresh_seconds: float, on_built=None):
+        try:
+            from usearch.index import Index
+        except ImportError:
+            logger.info("usearch is not installed, searching through the Supabase RPC")
+            return
+
+        while True:
+            try:
+                with self._build_lock:
+                    self.build(Index)
+                if on_built is not None:
+                    on_built()
+            except Exception:
+                logger.exception("Error building document index")
+            if refresh_seconds <= 0:
+                return
+            time.sleep(refresh_seconds)
+
+    def build(self, index_class) -> None:
+        contents, embeddings = [], []
+        page_start = 0
+        while True:
+            rows = supabase.table('strudel_docs') \
+                .select('content, embedding') \
+                .order('id') \
+                .range(page_start, page_start + DOC_INDEX_PAGE_SIZE - 1) \
+                .execute().data
+            for row in rows:
+                contents.append(row['content'])
+                # pgvector columns come back from PostgREST as '[x,y,...]' strings
+                embedding = row['embedding']
+                embeddings.append(orjson.loads(embedding) if isinstance(embedding, str) else embedding)
+            if len(rows) < DOC_INDEX_PAGE_SIZE:
+                break
+            page_start += DOC_INDEX_PAGE_SIZE
+
+        # Normalize once here so float indexes can score with a plain inner product.
+        # usearch's i8 'ip' returns raw integer dot products, so i8 keeps 'cos'.
+        metric = 'cos' if DOC_INDEX_DTYPE == 'i8' else 'ip'
+        index = index_class(ndim=EMBEDDING_DIM, metric=metric, dtype=DOC_INDEX_DTYPE)
+        if contents:
+            index.add(np.arange(len(contents)), normalize_embeddings(np.asarray(embeddings, dtype=np.float32)))
+
+        with self._lock:
+            self._index, self._contents = index, contents
+        logger.info("Document index built with %d documents", len(contents))
+
+    def search(self, embedding, match_count: int, match_threshold: float) -> list[dict] | None:
+        """Top matches as match_documents rows ({'content', 'similarity'}), or None if not built"""
+        with self._lock:
+            index, contents = self._index, self._contents
+        if index is None:
+            return None
+        if not contents or match_count < 1:
+            return []
+
+        matches = index.search(np.asarray(embedding, dtype=np.float32), int(match_count))
+        results = []
+        for key, distance in zip(matches.keys, matches.distances):
+            # usearch reports 1 - cosine ('cos'), or 1 - dot ('ip'), the same for unit vectors
+            similarity = 1 - float(distance)
+            if similarity > match_threshold:
+                results.append({"content": contents[key], "similarity": similarity})
+        return results
+
+doc_index = DocumentIndex()
+
+def format_result(index: int, doc: dict) -> str:
+    """Render one match_documents row, in the same layout as sql/match_documents_formatted.sql"""
+    return f"--- Result {index} (Similarity: {doc['similarity']:.2f}) ---\n{doc['content']}\n"
+
+def format_results(matches: list[dict]) -> str:
+    """Render match_documents rows as the text returned by search_strudel_docs"""
+    if not matches:
+        return NO_RESULTS_TEXT
+    return "\n".join([format_result(idx, doc) for idx, doc in enumerate(matches, 1)])
+
+def search_docs(query: str, max_results: int) -> str:
+    """Run search_strudel_docs and return its text result"""
+    # Generate embedding (exact repeats are served from the LRU cache)
+    query_embedding = get_query_embedding(query)
+
+    # Near-identical queries reuse the previous search results
+    result_text = search_cache.get(query_embedding, max_results)
+    if result_text is not None:
+        return result_text
+
+    if QUERY_PREFETCH:
+        prefetch_query_variants(query)
+
+    # Search the in-process index when it is ready
+    matches = doc_index.search(query_embedding, max_results, MATCH_THRESHOLD)
+
+    if matches is not None:
+        result_text = format_results(matches)
+    else:
+        # Search database; results come back already formatted (sql/match_documents_formatted.sql)
+        result_text = supabase_rpc(
+            'match_documents_formatted',
+            {
+                'query_embedding': query_embedding,
+                'match_threshold': MATCH_THRESHOLD,
+                'match_count': max_results
+            }
+        ) or NO_RESULTS_TEXT
+
+    search_cache.put(query_embedding, max_results, result_text)
+    return result_text
+
+def search_matches(query: str, max_results: int) -> list[dict]:
+    """Run search_strudel_docs and return the matching match_documents rows"""
+    query_embedding = get_query_embedding(query)
+    matches = doc_index.search(query_embedding, max_results, MATCH_THRESHOLD)
+    if matches is None:
+        matches = supabase_rpc(
+            'match_documents',
+            {
+                'query_embedding': query_embedding,
+                'match_threshold': MATCH_THRESHOLD,
+                'match_count': max_results
+            }
+        )
+    return matches
+
+def warm_up_embeddings():
+    """Embed a dummy text to load the model and open the connection pool"""
+    try:
+        generate_embedding("warmup")
+        logger.info("Embedding backend warmed up")
+    except Exception as e:
+        logger.warning("Embedding warmup failed: %s", e)
+
 # Flask app
 flask_app = Flask(__name__)
 CORS(flask_app, resources={r"/*": {"origins": "*", "allow_headers": "*"}})
@@ -84,9 +667,11 @@ TOOLS = [
                     "description": "The search query (e.g., 'how to use samples', 'mini notation syntax')"
                 },
                 "maxResults": {
-                    "type": "number",
-                    "description": "Maximum number of results (default: 3)",
-                    "default": 3
+                    "type": "integer",
+                    "description": f"Maximum number of results (default: {DEFAULT_MAX_RESULTS})",
+                    "default": DEFAULT_MAX_RESULTS,
+                    "minimum": 1,
+                    "maximum": MAX_RESULTS_LIMIT
                 }
             },
             "required": ["query"]
@@ -94,43 +679,132 @@ TOOLS = [
     }
 ]
 
+def _rpc_result_template(result) -> tuple[bytes, bytes]:
+    """Pre-serialize a constant JSON-RPC result as the bytes before and after its id value"""
+    body = orjson.dumps({"jsonrpc": "2.0", "id": None, "result": result})
+    # "id" is serialized before "result", so the first null is always the envelope's id
+    head, tail = body.split(b'"id":null', 1)
+    return head + b'"id":', tail
+
+def _json_bytes_response(body: bytes, status: int = 200) -> Response:
+    return flask_app.response_class(body, status=status, mimetype='application/json')
+
+def ojsonify(obj, status: int = 200) -> Response:
+    """Serialize obj straight to a JSON response with orjson, skipping jsonify's argument handling"""
+    return _json_bytes_response(orjson.dumps(obj), status)
+
+def _rpc_result_response(template: tuple[bytes, bytes], msg_id) -> Response:
+    head, tail = template
+    return _json_bytes_response(b"".join((head, orjson.dumps(msg_id), tail)))
+
+# SERVER_INFO and TOOLS never change, so their responses are serialized once
+_INITIALIZE_TEMPLATE = _rpc_result_template(SERVER_INFO)
+_TOOLS_LIST_TEMPLATE = _rpc_result_template({"tools": TOOLS})
+_HOME_BODY = orjson.dumps({
+    "status": "ok",
+    "service": "Strudel MCP Server",
+    "protocol": "MCP with SSE",
+    "version": "1.0.0",
+    "endpoints": {
+        "sse": "/sse",
+        "message": "/message",
+        "health": "/health"
+    }
+})
+_HEALTH_BODY = orjson.dumps({'status': 'healthy'})
+
+# search_strudel_docs arguments; maxResults is bounded because it sizes the
+# index search and keys the semantic cache
+_SEARCH_ARGUMENTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "query": {"type": "string"},
+        "maxResults": {"type": "integer", "minimum": 1, "maximum": MAX_RESULTS_LIMIT, "default": DEFAULT_MAX_RESULTS}
+    },
+    "default": {}
+}
+
+# Compiled once. Defaults are filled in only where the parent object was sent:
+# id and params always exist afterwards, but a defaulted params has no
+# arguments and a defaulted arguments has no maxResults, so handlers .get those
+_validate_mcp_message = fastjsonschema.compile({
+    "type": "object",
+    "properties": {
+        "method": {"type": "string"},
+        "id": {"type": ["string", "number", "null"], "default": None},
+        "params": {
+            "type": "object",
+            "properties": {
+                "arguments": _SEARCH_ARGUMENTS_SCHEMA
+            },
+            "default": {}
+        }
+    },
+    "required": ["method"]
+})
+
+# Body of /tools/call/stream: the params object of a tools/call message
+_validate_tool_call = fastjsonschema.compile({
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "arguments": _SEARCH_ARGUMENTS_SCHEMA
+    }
+})
+
+def read_mcp_message():
+    """Parse the request body with orjson, returning (message, None) or (None, error response)"""
+    try:
+        return orjson.loads(request.get_data(cache=False)), None
+    except orjson.JSONDecodeError as e:
+        return None, mcp_response({
+            "jsonrpc": "2.0",
+            "id": None,
+            "error": {
+                "code": -32700,
+                "message": f"Parse error: {str(e)}"
+            }
+        }, 400)
+
 def process_mcp_message(message):
     """Process an MCP JSON-RPC message"""
     try:
-        method = message.get('method')
-        params = message.get('params', {})
-        msg_id = message.get('id')
+        _validate_mcp_message(message)
+    except fastjsonschema.JsonSchemaException as e:
+        return {
+            "jsonrpc": "2.0",
+            "id": message.get('id') if isinstance(message, dict) else None,
+            "error": {
+                "code": -32600,
+                "message": f"Invalid Request: {e.message}"
+            }
+        }, 400
+
+    try:
+        method = message['method']
+        params = message['params']
+        msg_id = message['id']
 
-        print(f"Received MCP message: {method}")
+        logger.debug("Received MCP message: %s (id=%r)", method, msg_id)
 
         # Handle initialize
         if method == 'initialize':
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": SERVER_INFO
-            }
-            return response, 200
+            return _rpc_result_response(_INITIALIZE_TEMPLATE, msg_id), 200
 
         # Handle tools/list
         elif method == 'tools/list':
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "tools": TOOLS
-                }
-            }
-            return response, 200
+            return _rpc_result_response(_TOOLS_LIST_TEMPLATE, msg_id), 200
 
         # Handle tools/call
         elif method == 'tools/call':
             tool_name = params.get('name')
+            # params is only defaulted to {}, so arguments and maxResults can still be absent
             arguments = params.get('arguments', {})
 
             if tool_name == 'search_strudel_docs':
                 query = arguments.get('query')
-                max_results = arguments.get('maxResults', 3)
+                # Validated as an integer, but JSON numbers like 3.0 still arrive as floats
+                max_results = int(arguments.get('maxResults', DEFAULT_MAX_RESULTS))
 
                 if not query:
                     return {
@@ -143,31 +817,8 @@ def process_mcp_message(message):
                     }, 400
 
                 try:
-                    # Generate embedding
-                    query_embedding = generate_embedding(query)
-
-                    # Search database
-                    db_response = supabase.rpc(
-                        'match_documents',
-                        {
-                            'query_embedding': query_embedding,
-                            'match_threshold': 0.2,
-                            'match_count': max_results
-                        }
-                    ).execute()
-
-                    if not db_response.data:
-                        result_text = "No relevant documentation found for your query."
-                    else:
-                        results = []
-                        for idx, doc in enumerate(db_response.data, 1):
-                            results.append(
-                                f"--- Result {idx} (Similarity: {doc['similarity']:.2f}) ---\n"
-                                f"{doc['content']}\n"
-                            )
-                        result_text = "\n".join(results)
-                    
-                    print(f"Search results:\n{result_text}")
+                    result_text = search_docs(query, max_results)
+                    logger.debug("Search returned %d chars for id=%r", len(result_text), msg_id)
 
                     response = {
                         "jsonrpc": "2.0",
@@ -217,7 +868,7 @@ def process_mcp_message(message):
             }, 400
 
     except Exception as e:
-        print(f"Error handling message: {e}")
+        logger.exception("Error handling message")
         return {
             "jsonrpc": "2.0",
             "id": message.get('id'),
@@ -227,6 +878,17 @@ def process_mcp_message(message):
             }
         }, 500
 
+def mcp_response(result, status):
+    """Turn a process_mcp_message result into a Flask response"""
+    if status == 204:
+        return '', 204
+
+    # Constant results come back already serialized
+    if isinstance(result, Response):
+        return result, status
+
+    return ojsonify(result, status)
+
 @flask_app.route('/', methods=['GET', 'POST', 'HEAD'])
 def home():
     """Root endpoint - handles GET, POST, and HEAD requests"""
@@ -236,37 +898,92 @@ def home():
     
     # Handle GET requests
     if request.method == 'GET':
-        return jsonify({
-            "status": "ok",
-            "service": "Strudel MCP Server",
-            "protocol": "MCP with SSE",
-            "version": "1.0.0",
-            "endpoints": {
-                "sse": "/sse",
-                "message": "/message",
-                "health": "/health"
-            }
-        }), 200
+        return _json_bytes_response(_HOME_BODY), 200
 
     # Handle POST requests (for streamable_http transport initialize)
     if request.method == 'POST':
         if not request.is_json:
-            return jsonify({'error': 'Content-Type must be application/json'}), 400
-
-        message = request.get_json()
-        result, status = process_mcp_message(message)
+            return ojsonify({'error': 'Content-Type must be application/json'}, 400)
 
-        if status == 204:
-            return '', 204
+        message, error = read_mcp_message()
+        if error:
+            return error
 
-        return jsonify(result), status
+        result, status = process_mcp_message(message)
+        return mcp_response(result, status)
 
 @flask_app.route('/health', methods=['GET', 'HEAD'])
 def health():
     """Health check endpoint"""
     if request.method == 'HEAD':
         return '', 200
-    return jsonify({'status': 'healthy'}), 200
+    return _json_bytes_response(_HEALTH_BODY), 200
+
+# Set when the process is asked to stop so open SSE streams end instead of
+# holding their worker until the graceful timeout kills it
+sse_shutdown = threading.Event()
+
+def install_shutdown_handler():
+    """Set sse_shutdown on SIGTERM/SIGINT, then run the handler already installed
+    (gunicorn's worker handlers, or Python's KeyboardInterrupt for the dev server)"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(signum)
+
+        def handler(sig, frame, previous=previous):
+            sse_shutdown.set()
+            if callable(previous):
+                previous(sig, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(sig, signal.SIG_DFL)
+                signal.raise_signal(sig)
+
+        signal.signal(signum, handler)
+
+class KeepaliveBroadcaster:
+    """One thread that sends keepalive comments to every open SSE stream
+
+    Each stream subscribes a queue and yields whatever arrives on it, so K idle
+    clients cost one wakeup per interval instead of K. On shutdown every queue
+    receives None, which ends its stream.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers: set[queue.SimpleQueue] = set()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name="sse-keepalive", daemon=True).start()
+
+    def subscribe(self) -> queue.SimpleQueue:
+        q = queue.SimpleQueue()
+        with self._lock:
+            self._subscribers.add(q)
+        if sse_shutdown.is_set():
+            q.put(None)
+        return q
+
+    def unsubscribe(self, q: queue.SimpleQueue) -> None:
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def _broadcast(self, message: str | None) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            q.put(message)
+
+    def _run(self):
+        count = 0
+        while not sse_shutdown.wait(self.interval):
+            count += 1
+            # Keepalive comment (lines starting with : are ignored by SSE spec)
+            self._broadcast(f": keepalive {count}\n\n")
+        self._broadcast(None)
+
+keepalive_broadcaster = KeepaliveBroadcaster(SSE_KEEPALIVE_INTERVAL)
 
 @flask_app.route('/sse', methods=['GET'])
 def sse_endpoint():
@@ -279,21 +996,21 @@ def sse_endpoint():
             host = request.headers.get('X-Forwarded-Host', request.host)
             endpoint_url = f"{scheme}://{host}/message"
         except Exception as e:
-            print(f"Error building endpoint URL: {e}")
+            logger.warning("Error building endpoint URL: %s", e)
             endpoint_url = request.host_url.rstrip('/') + '/message'
 
-        print(f"SSE: Sending endpoint URL: {endpoint_url}")
+        logger.debug("SSE: Sending endpoint URL: %s", endpoint_url)
         
         # Send endpoint event FIRST (this is critical for MCP)
         yield f"event: endpoint\ndata: {endpoint_url}\n\n"
 
-        # Keep connection alive with periodic messages
-        count = 0
-        while True:
-            time.sleep(30)
-            count += 1
-            # Send keepalive comment (lines starting with : are ignored by SSE spec)
-            yield f": keepalive {count}\n\n"
+        # Keep connection alive with the shared keepalives until the worker shuts down
+        messages = keepalive_broadcaster.subscribe()
+        try:
+            while (message := messages.get()) is not None:
+                yield message
+        finally:
+            keepalive_broadcaster.unsubscribe(messages)
 
     return Response(
         stream_with_context(generate()),
@@ -314,22 +1031,130 @@ def message_endpoint():
         return '', 204
 
     if not request.is_json:
-        return jsonify({'error': 'Content-Type must be application/json'}), 400
+        return ojsonify({'error': 'Content-Type must be application/json'}, 400)
+
+    message, error = read_mcp_message()
+    if error:
+        return error
 
-    message = request.get_json()
-    print(f"Received message: {json.dumps(message, indent=2)}")
-    
     result, status = process_mcp_message(message)
+    return mcp_response(result, status)
 
-    if status == 204:
-        return '', 204
+@flask_app.route('/cache/clear', methods=['POST'])
+def cache_clear():
+    """Drop the caches of the worker serving the request and reload its document index
+
+    Use after re-ingesting the docs. The in-process index is rebuilt in the
+    background; search results cached from the old index until then are
+    dropped again once the new one is in place. Only this worker is cleared:
+    with several gunicorn workers the others catch up through
+    SEMANTIC_CACHE_TTL and DOC_INDEX_REFRESH, as the response says.
+    """
+    auth = request.headers.get('Authorization', '').encode()
+    if not ADMIN_TOKEN or not hmac.compare_digest(auth, f"Bearer {ADMIN_TOKEN}".encode()):
+        return ojsonify({'error': 'Forbidden'}, 403)
+
+    get_query_embedding.cache_clear()
+    search_cache.clear()
+    result = {
+        'status': 'cleared',
+        'worker': os.getpid(),
+        'note': 'Only this worker was cleared; other workers expire cached results after '
+                'SEMANTIC_CACHE_TTL and reload their index every DOC_INDEX_REFRESH seconds (never if 0)'
+    }
+    if DOC_INDEX_ENABLED:
+        doc_index.refresh(on_built=search_cache.clear)
+        result['index'] = 'rebuilding'
+    return ojsonify(result, 200)
+
+def send_sse_message(data, event: str | None = None) -> str:
+    """Format a JSON payload as one SSE frame"""
+    event_line = f"event: {event}\n" if event else ""
+    return f"{event_line}data: {orjson.dumps(data).decode()}\n\n"
+
+@flask_app.route('/tools/call/stream', methods=['POST'])
+def tools_call_stream():
+    """Stream search_strudel_docs results as SSE frames, one per matching document
+
+    Takes the same body as tools/call params: {"name": ..., "arguments": {...}}.
+    Each result is sent as {"chunk": text}, followed by a final "done" event.
+    """
+    if not request.is_json:
+        return ojsonify({'error': 'Content-Type must be application/json'}, 400)
+
+    try:
+        params = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError as e:
+        return ojsonify({'error': f"Invalid JSON: {str(e)}"}, 400)
+
+    try:
+        _validate_tool_call(params)
+    except fastjsonschema.JsonSchemaException as e:
+        return ojsonify({'error': f"Invalid request: {e.message}"}, 400)
+
+    tool_name = params.get('name')
+    if tool_name != 'search_strudel_docs':
+        return ojsonify({'error': f"Unknown tool: {tool_name}"}, 400)
+
+    arguments = params['arguments']
+    query = arguments.get('query')
+    # Validated as an integer; the default is not filled in when arguments itself was defaulted
+    max_results = int(arguments.get('maxResults', DEFAULT_MAX_RESULTS))
+    if not query:
+        return ojsonify({'error': 'Missing required argument: query'}, 400)
+
+    try:
+        matches = search_matches(query, max_results)
+    except Exception as e:
+        return ojsonify({'error': f"Error searching documentation: {str(e)}"}, 500)
+
+    def generate():
+        if not matches:
+            yield send_sse_message({"chunk": NO_RESULTS_TEXT})
+
+        for idx, doc in enumerate(matches or [], 1):
+            yield send_sse_message({"chunk": format_result(idx, doc)})
+
+        yield send_sse_message({}, event="done")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def start_background_services():
+    """Start the work only a serving process needs
+
+    Installs the shutdown handler, starts the SSE keepalives, warms up the
+    embedding backend and builds the document index. Kept out of module
+    import so scripts such as populate_db.py can use the embedding and
+    Supabase helpers without them; gunicorn.conf.py calls this from
+    post_worker_init, and __main__ before running the dev server.
+    """
+    install_shutdown_handler()
+    keepalive_broadcaster.start()
+
+    if EMBEDDING_WARMUP:
+        if onnx_session is not None:
+            # Local model: run the graph once now so its optimizations and thread pools are ready
+            warm_up_embeddings()
+        else:
+            # HF API: cold model loads can take seconds, so don't block startup on them
+            threading.Thread(target=warm_up_embeddings, name="embedding-warmup", daemon=True).start()
 
-    return jsonify(result), status
+    if DOC_INDEX_ENABLED:
+        doc_index.start(DOC_INDEX_REFRESH)
 
+# Local development only; deployments run under gunicorn via start.sh
 if __name__ == "__main__":
     port = int(os.getenv('PORT', 3000))
-    print(f"Starting MCP SSE server on port {port}")
-    print("SSE endpoint: /sse")
-    print("Message endpoint: /message")
-    print("Health check: /health")
-    flask_app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
\ No newline at end of file
+    logger.info("Starting MCP SSE server on port %s", port)
+    logger.info("SSE endpoint: /sse")
+    logger.info("Message endpoint: /message")
+    logger.info("Health check: /health")
+    start_background_services()
+    flask_app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,46 @@
+-- Cosine search over strudel_docs backed by an HNSW index.
+-- populate_db.py inserts L2-normalized embeddings; the update below brings
+-- rows stored before that in line, so cosine distance (<=>) orders the same
+-- as a dot product. Similarity is 1 - distance either way.
+--
+-- The index is built on a half-precision copy of the embedding (768 B per
+-- row instead of 1536 B), which halves the bytes the ANN scan touches. The
+-- candidates it returns are re-ranked with the full-precision column.
+-- Requires pgvector >= 0.7 for halfvec and l2_normalize.
+update strudel_docs set embedding = l2_normalize(embedding);
+
+alter table strudel_docs
+  add column if not exists embedding_h halfvec(384)
+  generated always as (embedding::halfvec(384)) stored;
+
+drop index if exists strudel_docs_embedding_hnsw_idx;
+create index if not exists strudel_docs_embedding_h_hnsw_idx
+  on strudel_docs using hnsw (embedding_h halfvec_cosine_ops)
+  with (m = 16, ef_construction = 64);
+
+drop function if exists match_documents(vector, float, int);
+
+create function match_documents(
+  query_embedding vector(384),
+  match_threshold float,
+  match_count int
+)
+returns table (id bigint, content text, similarity float)
+language sql stable
+-- An HNSW scan returns at most ef_search rows (no iterative scans), so this must
+-- cover the 50-row candidate pool below, which in turn covers MAX_RESULTS_LIMIT
+-- in server.py; 100 also buys recall headroom over that pool
+set hnsw.ef_search = 100
+as $$
+  select id, content, 1 - (embedding <=> query_embedding) as similarity
+  from (
+    -- Approximate top candidates from the halfvec index
+    select id, content, embedding
+    from strudel_docs
+    order by embedding_h <=> query_embedding::halfvec(384)
+    limit greatest(match_count, 50)
+  ) candidates
+  where embedding <=> query_embedding < 1 - match_threshold
+  order by embedding <=> query_embedding
+  limit match_count;
+$$;
@@ -0,0 +1,20 @@
+-- Wraps match_documents and formats the matches into the text block returned
+-- by the search_strudel_docs tool, so the server receives one string instead
+-- of every matching row as JSON. Returns null when nothing matches.
+create or replace function match_documents_formatted(
+  query_embedding vector(384),
+  match_threshold float,
+  match_count int
+)
+returns text
+language sql stable
+as $$
+  select string_agg(
+    format(E'--- Result %s (Similarity: %s) ---\n%s\n', rank, to_char(similarity, 'FM0.00'), content),
+    E'\n' order by rank
+  )
+  from (
+    select content, similarity, row_number() over (order by similarity desc) as rank
+    from match_documents(query_embedding, match_threshold, match_count)
+  ) matches;
+$$;
@@ -1,5 +1,4 @@
-
 #!/bin/bash
 
-# Start the Python MCP server
-python server.py
\ No newline at end of file
+# Start the Python MCP server (settings, including the app module, in gunicorn.conf.py)
+exec gunicorn -c gunicorn.conf.py